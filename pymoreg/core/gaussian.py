@@ -191,7 +191,7 @@ def to_mvn(mean, var, beta, return_mvn=False, rng=None):
     return_mvn: bool
         See below in returned values
 
-    rng: numpy.random.RandomState
+    rng: numpy.random.Generator
         If return_mvn is true this is the random number generator used in the frozen multivariate normal instance.
 
     Returns
@@ -321,7 +321,7 @@ def fit_mvn(data, rng=None):
     data: numpy.ndarray
         An array of shape (N, D) wih the sample data used to estimate the MVN
 
-    rng: numpy.random.RandomState
+    rng: numpy.random.Generator
         The random generator used to initialize the random variable
 
     Returns
@@ -1,11 +1,16 @@
 import numpy as np
 from itertools import chain, combinations
+from numba import njit
+from scipy.special import comb
 
 
 def get_rng(seed=None):
-    if isinstance(seed, np.random.RandomState):
+    if isinstance(seed, np.random.Generator):
         return seed
-    return np.random.RandomState(seed)
+    if isinstance(seed, np.random.RandomState):
+        # Legacy generators are only used to seed a new one
+        seed = seed.randint(2 ** 32)
+    return np.random.default_rng(seed)
 
 
 def power_set(iterable, max_size=-1):
@@ -18,6 +23,84 @@ def power_set(iterable, max_size=-1):
     return list(sets)
 
 
+@njit(cache=True)
+def _enumerate_subsets_bits(n, max_size, out):
+    # Write the bitmask of every subset of range(n) of size at most max_size into out, in the same order as
+    # power_set: by size and then lexicographically.
+    pos = 0
+    idx = np.empty(max_size, dtype=np.int64)
+
+    for k in range(max_size + 1):
+        for i in range(k):
+            idx[i] = i
+
+        while True:
+            bits = np.uint64(0)
+            for i in range(k):
+                bits |= np.uint64(1) << np.uint64(idx[i])
+
+            out[pos] = bits
+            pos += 1
+
+            # Advance the rightmost index that has not reached its last position and reset the ones after it
+            i = k - 1
+            while i >= 0 and idx[i] == n - k + i:
+                i -= 1
+
+            if i < 0:
+                break
+
+            idx[i] += 1
+            for j in range(i + 1, k):
+                idx[j] = idx[j - 1] + 1
+
+    return out
+
+
+def power_set_bits(n, max_size=-1):
+    # Same as power_set(range(n), max_size) but with each subset as a 64 bit mask
+    if max_size == -1 or max_size > n:
+        max_size = n
+
+    size = sum(comb(n, k, exact=True) for k in range(max_size + 1))
+
+    return _enumerate_subsets_bits(n, max_size, np.empty(size, dtype=np.uint64))
+
+
+_bit_positions = np.arange(64, dtype=np.uint64)
+
+
+def to_bits(indices):
+    # Pack a collection of variable indices into an integer bitmask
+    bits = 0
+    for i in indices:
+        bits |= 1 << int(i)
+    return bits
+
+
+def from_bits(bits):
+    # Unpack a 64 bit mask into the sorted array of indices that are set
+    return np.flatnonzero((np.uint64(bits) >> _bit_positions) & np.uint64(1))
+
+
+def unpack_bits(bits, n=64):
+    # Boolean array with the first n bits of each mask along a new last axis
+    return ((np.asarray(bits, dtype=np.uint64)[..., None] >> _bit_positions[:n]) & np.uint64(1)).astype(bool)
+
+
+def popcount(bits):
+    # Number of bits set in each entry of an array of 64 bit masks (SWAR)
+    x = np.asarray(bits, dtype=np.uint64)
+    x = x - ((x >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    x = (x & np.uint64(0x3333333333333333)) + ((x >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    x = (x + (x >> np.uint64(4))) & np.uint64(0x0f0f0f0f0f0f0f0f)
+    x = x + (x >> np.uint64(8))
+    x = x + (x >> np.uint64(16))
+    x = x + (x >> np.uint64(32))
+
+    return (x & np.uint64(0x7f)).astype(int)
+
+
 def det_2by2(m):
     return m[0, 0] * m[1, 1] - m[0, 1] * m[1, 0]
 
@@ -1,5 +1,7 @@
 import networkx as nx
+import numpy as np
 
+from pymoreg.core.misc import to_bits
 from pymoreg.mcmc.graphs.state_space import RestrictionViolation, DAGState
 
 
@@ -47,3 +49,33 @@ def check_consistency(state: DAGState):
                 'Fan in restriction violated. |Pa({0})| = {1} > {2}'.format(v, card_pa, state.fan_in))
 
     return True
+
+
+def check_cached_structures(state: DAGState):
+    # The bitsets, arcs and addable arcs are updated incrementally, so they must match those of a new state
+    fresh = type(state)(state.adj.copy(), fan_in=state.fan_in)
+
+    for attr in ['parents_bits', 'anc_bits', 'desc_bits', '_addable', '_addable_counts']:
+        if not np.array_equal(getattr(state, attr), getattr(fresh, attr)):
+            raise ValueError('State.{0} is not consistent with the graph'.format(attr))
+
+    if state.n_addable_ != fresh.n_addable_:
+        raise ValueError('Counted {0} addable arcs, expected {1}'.format(state.n_addable_, fresh.n_addable_))
+
+    if sorted(state.edges()) != sorted(fresh.edges()):
+        raise ValueError('State.edges() is not consistent with the graph')
+
+    return True
+
+
+def check_orphan_descendants(state: DAGState, orphans):
+    # Compare against the descendants after actually removing the parents of the orphans
+    orphaned = state.copy()
+    orphaned.orphan(list(orphans))
+
+    for v in orphans:
+        expected = to_bits(orphaned.descendants(v))
+        if state.orphan_descendants(v, orphans) != expected:
+            raise ValueError('Wrong descendants for node {0} after orphaning {1}'.format(v, orphans))
+
+    return True
@@ -1,11 +1,9 @@
-from collections import OrderedDict
-from itertools import product
-
 import numpy as np
-import scipy.sparse as ssp
-from scipy.special import binom, logsumexp, logit
+from joblib import Parallel, delayed
+from numba import njit
+from scipy.special import binom, logit
 
-from pymoreg.core.misc import get_rng, power_set
+from pymoreg.core.misc import from_bits, get_rng, popcount, power_set_bits, to_bits, unpack_bits
 from pymoreg.metrics.score import BGe
 from pymoreg.structure.graph_generation import random_dag, random_mbc
 
@@ -13,6 +11,67 @@ from pymoreg.mcmc.graphs.state_space import DAGState, MBCState
 from pymoreg.mcmc.sampling import ProposalDistribution
 
 
+@njit(cache=True, fastmath=True)
+def _running_logsumexp(scores, psets_bits, required, forbidden):
+    # One pass log-sum-exp over the parent sets that contain required and avoid forbidden: keep a running maximum
+    # and rescale the partial sum whenever it changes. Returns both so the sum can be reused for sampling.
+    m = 0.0
+    s = 0.0
+    found = False
+
+    for k in range(scores.shape[0]):
+        bits = psets_bits[k]
+        if (bits & forbidden) != 0 or (bits & required) != required:
+            continue
+
+        x = scores[k]
+        if not found:
+            m = x
+            s = 1.0
+            found = True
+        elif x <= m:
+            s += np.exp(x - m)
+        else:
+            s = s * np.exp(m - x) + 1.0
+            m = x
+
+    if not found:
+        raise ValueError('No parent set satisfies the condition')
+
+    return m, s
+
+
+@njit(cache=True, fastmath=True)
+def _logsumexp_filtered(scores, psets_bits, required, forbidden):
+    m, s = _running_logsumexp(scores, psets_bits, required, forbidden)
+    return np.log(s) + m
+
+
+@njit(cache=True, fastmath=True)
+def _sample_filtered(scores, psets_bits, required, forbidden, u):
+    # Sample one of the parent sets that contain required and avoid forbidden, returning its index and the
+    # log-partition function of the selected sets. The first pass computes the log-sum-exp, the second one
+    # inverts the cumulative distribution at the pre-drawn uniform u.
+    m, s = _running_logsumexp(scores, psets_bits, required, forbidden)
+
+    target = u * s
+    cumulative = 0.0
+    last = -1
+
+    for k in range(scores.shape[0]):
+        bits = psets_bits[k]
+        if (bits & forbidden) != 0 or (bits & required) != required:
+            continue
+
+        cumulative += np.exp(scores[k] - m)
+        last = k
+
+        if cumulative > target:
+            break
+
+    return last, np.log(s) + m
+
+
 class ParentSetDistribution:
     """
     This type subclasses CPT to be used as distribution of parent sets for a node.
@@ -21,67 +80,83 @@ class ParentSetDistribution:
     ----------
     var: int
         The index of the variable
-    parent_sets: list of array like or frozenset
-        The possible parent sets of the variable by index
+    parent_sets: list of array like or frozenset, or numpy.ndarray of uint64
+        The possible parent sets of the variable by index, or their bitmasks
     probabilities: array like of float
         The probability of each parent set. Must be of same length of parent_sets.
-    rng: int, RandomState or None (default)
+    rng: int, Generator or None (default)
         A random number generator initializer
     """
 
     def __init__(self, var, parent_sets, probabilities, rng=None):
         if isinstance(var, int):
             var = 'X' + str(var)
-        if not isinstance(parent_sets[0], frozenset):
-            parent_sets = list(map(lambda x: frozenset(x), parent_sets))
 
+        if not (isinstance(parent_sets, np.ndarray) and parent_sets.dtype == np.uint64):
+            parent_sets = np.fromiter(map(to_bits, parent_sets), dtype=np.uint64, count=len(parent_sets))
+
+        # Parent sets and their scores are stored as parallel arrays, with an index from bitmask to position
         self.var_name = var
-        self.table = OrderedDict(zip(parent_sets, probabilities))
+        self._psets_bits = parent_sets
+        self._scores = np.asarray(probabilities, dtype=np.float64)
+        self._index = {int(bits): k for k, bits in enumerate(self._psets_bits)}
         self.rng = get_rng(rng)
 
     def __getitem__(self, item):
-        return self.table[item]
+        if not isinstance(item, (int, np.integer)):
+            item = to_bits(item)
+        return self.lookup_bits(item)
+
+    def lookup_bits(self, bits):
+        return self._scores[self._index[int(bits)]]
 
     @property
     def parent_sets(self):
-        return self.table.keys()
+        return [frozenset(from_bits(bits).tolist()) for bits in self._psets_bits]
 
     @property
     def log_proba(self):
-        return self.table.values()
-
-    def sample(self, condition=None):
-        if condition is None:
-            table = self.table.items()
-        else:
-            table = [kv for kv in self.table.items() if condition(kv[0])]
-
-        p_sets, prob = list(zip(*table))
-
-        if len(p_sets) == 1:
-            return p_sets[0], prob[0]
+        return self._scores
 
-        c = max(prob)
-        prob = np.exp(prob - c)
-        z = prob.sum()
-
-        return self.rng.choice(p_sets, p=prob / z), np.log(z) + c
-
-    def log_z(self, condition=None):
-        if condition is None:
-            selected = self.table.values()
-        else:
-            selected = [kv[1] for kv in self.table.items() if condition(kv[0])]
+    def sample(self, required=0, forbidden=0):
+        # Returns the bitmask of the sampled parent set and the log partition function of the allowed sets
+        idx, log_z = _sample_filtered(
+            self._scores, self._psets_bits, np.uint64(required), np.uint64(forbidden), self.rng.random())
 
-        selected = np.asarray(selected)
+        return self._psets_bits[idx], log_z
 
-        if len(selected) == 1:
-            return selected[0]
+    def log_z(self, required=0, forbidden=0):
+        return _logsumexp_filtered(self._scores, self._psets_bits, np.uint64(required), np.uint64(forbidden))
 
-        return logsumexp(selected)
 
+def get_parent_set_distributions(variables, fan_in, score_fn, condition=None, rng=None, n_jobs=1):
+    """
+    Score all the parent sets of each variable up to the fan in restriction.
 
-def get_parent_set_distributions(variables, fan_in, score_fn, condition=None, rng=None):
+    Parameters
+    ----------
+    variables: int or list
+        The variables or the number of variables
+    fan_in: int
+        The maximum size of the parent sets
+    score_fn: callable
+        Score function called as score_fn((var, parents)) where parents is an array with the variable indices. If it
+        has a batch_scores(var, psets_bits) method, it is used instead to score all the parent sets of a variable.
+    condition: callable or None (default)
+        Further restriction on the parent sets called as condition(var, psets_bits) where psets_bits is an array
+        with the bitmasks of the candidate parent sets. Must return a boolean mask of the ones to keep.
+    rng: int, Generator or None (default)
+        A random number generator initializer
+    n_jobs: int
+        Number of threads used to score the variables in parallel, -1 uses all processors. Only used when score_fn
+        has no batch_scores method, as batch scoring is already parallel over the parent sets. The score function is
+        shared by all threads, so it must not be modified by the calls.
+
+    Returns
+    -------
+    list of ParentSetDistribution:
+        The distribution over parent sets of each variable
+    """
     if isinstance(variables, int):
         n_variables = variables
     elif isinstance(variables, list):
@@ -89,22 +164,33 @@ def get_parent_set_distributions(variables, fan_in, score_fn, condition=None, rn
     else:
         raise ValueError("Expected variable list or number of variables")
 
+    if n_variables > 64:
+        raise ValueError('Parent sets are stored as 64 bit masks, got {0} variables'.format(n_variables))
+
     rng = get_rng(rng)
-    sets = power_set(range(n_variables), fan_in)
+    sets_bits = power_set_bits(n_variables, fan_in)
+
+    def score_one(var):
+        mask = ((sets_bits >> np.uint64(var)) & np.uint64(1)) == 0
+        if condition is not None:
+            mask &= condition(var, sets_bits)
 
-    pset_dists = []
+        var_psets = sets_bits[mask]
 
-    for var in range(n_variables):
-        if condition is None:
-            var_psets = list(filter(lambda s: var not in s, sets))
+        if hasattr(score_fn, 'batch_scores'):
+            scores = score_fn.batch_scores(var, var_psets)
         else:
-            var_psets = list(filter(lambda s: var not in s and condition(var, s), sets))
+            scores = [score_fn((var, from_bits(ps))) for ps in var_psets]
+
+        return ParentSetDistribution(var, var_psets, scores, rng)
 
-        scores = [score_fn((var, ps)) for ps in var_psets]
-        psd = ParentSetDistribution(var, var_psets, scores, rng)
-        pset_dists.append(psd)
+    # Under numba's workqueue threading layer parallel kernels can't be launched from several threads at once, and
+    # with the others both levels would compete for the cores. So batch scoring runs one variable at a time and only
+    # the calls to the score function are spread over the threads
+    if hasattr(score_fn, 'batch_scores'):
+        return [score_one(var) for var in range(n_variables)]
 
-    return pset_dists
+    return Parallel(n_jobs=n_jobs, prefer='threads')(delayed(score_one)(var) for var in range(n_variables))
 
 
 class GraphMove:
@@ -114,31 +200,13 @@ class GraphMove:
 
 
 class basic_move(GraphMove):
-    @staticmethod
-    def _n_adds(state):
-        add = ssp.csr_matrix(1 - np.identity(state.shape[0], dtype=np.int))
-        add -= state.adj + state.ancestor_matrix
-
-        add = add.tolil()
-        add[state.non_admissible_edges()] = 0
-
-        return len(add.nonzero()[0])
-
-    @staticmethod
-    def _n_deletes(state):
-        delete_arcs = state.adj.nonzero()
-        return len(delete_arcs[0])
-
     @staticmethod
     def moves(state):
-        add = ssp.csr_matrix(1 - np.identity(state.shape[0], dtype=np.int))
-        add -= state.adj + state.ancestor_matrix
+        # Row v holds the nodes that can become parents of v, so transpose to get the arcs as (tail, head)
+        add = unpack_bits(state.addable_bits(), state.shape[0])
 
-        add = add.tolil()
-        add[state.non_admissible_edges()] = 0
-
-        add_arcs = list(zip(*add.nonzero()))
-        delete_arcs = list(zip(*state.adj.nonzero()))
+        add_arcs = list(zip(*add.T.nonzero()))
+        delete_arcs = list(state.edges())
 
         return add_arcs, delete_arcs
 
@@ -147,34 +215,32 @@ class basic_move(GraphMove):
 
         # print('Selected Add/Delete')
 
-        add_arcs, delete_arcs = basic_move.moves(state)
-
-        can_add, can_delete = len(add_arcs), len(delete_arcs)
-        p = np.asarray([can_add, can_delete]) / (can_add + can_delete)
+        # The arcs that can be added or deleted are kept up to date by the state, so there's no need to list them
+        can_add, can_delete = state.n_addable_, state.n_edges_
 
         # Moves: ADD - 0, DELETE - 1
-        move = rng.choice([0, 1], p=p)
+        move = int(rng.random() * (can_add + can_delete) >= can_add)
         new_state = state.copy()
 
         if move:
             # Sample one arc and delete it
-            u, v = delete_arcs[rng.choice(can_delete)]
+            u, v = state.edges()[rng.integers(can_delete)]
             new_state.remove_edge(u, v)
         else:
             # Else, sample one arc and add it
-            u, v = add_arcs[rng.choice(can_add)]
+            u, v = state.addable_edge(rng.integers(can_add))
             new_state.add_edge(u, v)
 
         # Compute the ratio of the scores
-        z_old = scores[v][frozenset(state.adj.parents(v))]
-        z_new = scores[v][frozenset(new_state.adj.parents(v))]
+        z_old = scores[v].lookup_bits(state.parents_bits[v])
+        z_new = scores[v].lookup_bits(new_state.parents_bits[v])
 
         z_ratio = z_new - z_old
 
         # The probability of the move is the number of neighbors produced by addition and deletion.
         # The probability of the inverse is the same in the new graph
         q_move = can_add + can_delete
-        q_inv = basic_move._n_adds(new_state) + basic_move._n_deletes(new_state)
+        q_inv = new_state.n_addable_ + new_state.n_edges_
 
         # Return the new state, acceptance ratio and ratio of scores in log space
         return new_state, z_ratio + np.log(q_move / q_inv), z_ratio
@@ -183,48 +249,48 @@ class basic_move(GraphMove):
 class rev_move(GraphMove):
     @staticmethod
     def moves(state):
-        return list(zip(*state.reversible_edges(rev=True)))
+        return list(state.reversible_edges(rev=True))
 
     @staticmethod
     def propose(state: DAGState, scores, rng):
         # print('Selected REV')
 
-        arcs = rev_move.moves(state)
+        # Only read from, so there's no need to copy them
+        arcs = state.reversible_edges(rev=True)
         n = len(arcs)
 
         if not n:
             return state, -np.inf, 0
 
-        i, j = arcs[rng.choice(n)]
+        i, j = arcs[rng.integers(n)]
 
         # The descendants of i and j in the current graph
-        dsc_i, dsc_j = frozenset(state.descendants(i)), frozenset(state.descendants(j))
-        score_old = scores[i][frozenset(state.adj.parents(i))] + scores[j][frozenset(state.adj.parents(j))]
+        dsc_i, dsc_j = to_bits(state.descendants(i)), to_bits(state.descendants(j))
+        score_old = scores[i].lookup_bits(state.parents_bits[i]) + scores[j].lookup_bits(state.parents_bits[j])
 
         # Partition functions for the inverse move
         # Compute the z_score of i excluding it's descendants (including j).
         # Also the z_score* for j excluding it's descendants (i in its parent set)
-        z_i = scores[i].log_z(lambda ps: ps.isdisjoint(dsc_i))
-        z_star_j = scores[j].log_z(lambda ps: (i in ps) and ps.isdisjoint(dsc_j))
-
-        new_state = state.copy()
-        new_state.orphan([i, j])
-
-        dsc_i = frozenset(new_state.descendants(i))
-        ps_i, z_star_i = scores[i].sample(lambda ps: (j in ps) and ps.isdisjoint(dsc_i))
+        z_i = scores[i].log_z(forbidden=dsc_i)
+        z_star_j = scores[j].log_z(required=1 << i, forbidden=dsc_j)
 
-        new_state.add_edges(list(product(ps_i, [i])))
+        # The descendants of i once i and j are orphaned
+        dsc_i = state.orphan_descendants(i, [i, j])
+        ps_i, z_star_i = scores[i].sample(required=1 << j, forbidden=dsc_i)
 
-        dsc_j = frozenset(new_state.descendants(j))
-        ps_j, z_j = scores[j].sample(lambda ps: ps.isdisjoint(dsc_j))
+        # j is now a parent of i, so the descendants of i are also descendants of j
+        dsc_j = state.orphan_descendants(j, [i, j]) | (1 << i) | dsc_i
+        ps_j, z_j = scores[j].sample(forbidden=dsc_j)
 
-        new_state.add_edges(list(product(ps_j, [j])))
-        score_new = scores[i][frozenset(new_state.adj.parents(i))] + scores[j][frozenset(new_state.adj.parents(j))]
+        # Both parent sets are replaced at once to update the ancestors a single time
+        new_state = state.copy()
+        new_state.replace_parents({i: from_bits(ps_i), j: from_bits(ps_j)})
+        score_new = scores[i].lookup_bits(ps_i) + scores[j].lookup_bits(ps_j)
 
         log_z_ratios = z_star_i + z_j - z_star_j - z_i
         score_diff = score_new - score_old
 
-        return new_state, log_z_ratios + np.log(n / len(new_state.adj.nonzero()[0])), score_diff
+        return new_state, log_z_ratios + np.log(n / new_state.n_edges_), score_diff
 
 
 log2 = np.log(2)
@@ -234,7 +300,7 @@ class nbhr_move(GraphMove):
     def propose(state: DAGState, scores, rng):
         # print('Selected Reattach move')
 
-        node = rng.choice(state.adj.nodes())
+        node = rng.integers(state.shape[0])
 
         # Disconnect the node
         new_state = state.copy()
@@ -244,42 +310,38 @@ class nbhr_move(GraphMove):
 
         # Compute the change in score for each of the former children
         if len(children):
-            delta_child_score = sum(scores[v][frozenset(new_state.adj.parents(v))] -
-                                    scores[v][frozenset(state.adj.parents(v))] for v in children)
+            delta_child_score = sum(scores[v].lookup_bits(new_state.parents_bits[v]) -
+                                    scores[v].lookup_bits(state.parents_bits[v]) for v in children)
 
         else:
             delta_child_score = 0
 
         # Sample a new parent set
         new_ps, _ = scores[node].sample()
-        new_state.add_edges(product(new_ps, [node]))
+        new_state.add_parents(node, from_bits(new_ps))
 
         # Compute the new parent set ratio of node
-        parent_set_ratio = scores[node][frozenset(new_state.adj.parents(node))] - \
-            scores[node][frozenset(state.adj.parents(node))]
+        parent_set_ratio = scores[node].lookup_bits(new_state.parents_bits[node]) - \
+            scores[node].lookup_bits(state.parents_bits[node])
 
-        # Select arcs for addition
-        add = ssp.csr_matrix(1 - np.identity(new_state.shape[0], dtype=np.int))
-        add -= new_state.adj + new_state.ancestor_matrix
+        # Select arcs for addition: the nodes that can take node as a parent
+        heads = ((new_state.addable_bits() >> np.uint64(node)) & np.uint64(1)).nonzero()[0]
 
-        add = add.tolil()
-        add[new_state.non_admissible_edges()] = 0
-
-        add_arcs = np.asarray(list(filter(lambda e: e[0] == node and e[1] not in children, zip(*add.nonzero()))))
+        add_arcs = np.asarray([(node, v) for v in heads if v not in children])
         n_add_arcs = len(add_arcs)
 
         if n_add_arcs:
             # Probability of selecting an new children subset is proportional to the size of that subset.
             # This ensures all edges are selected uniformly.
-            set_size_prob = [binom(n_add_arcs, i) for i in range(n_add_arcs + 1)]
-            k = rng.choice(len(add_arcs) + 1, p=set_size_prob / np.sum(set_size_prob))
+            set_size_cdf = np.cumsum([binom(n_add_arcs, i) for i in range(n_add_arcs + 1)])
+            k = np.searchsorted(set_size_cdf, rng.random() * set_size_cdf[-1], side='right')
 
             if k:
                 add_arcs = add_arcs[rng.choice(n_add_arcs, size=k, replace=False)]
                 new_state.add_edges(add_arcs)
 
-                delta_child_score += sum(scores[v][frozenset(new_state.adj.parents(v))] -
-                                         scores[v][frozenset(state.adj.parents(v))] for _, v in add_arcs)
+                delta_child_score += sum(scores[v].lookup_bits(new_state.parents_bits[v]) -
+                                         scores[v].lookup_bits(state.parents_bits[v]) for _, v in add_arcs)
 
         score_ratio = delta_child_score + parent_set_ratio
         move_prob_ratio = (n_add_arcs - len(children)) * log2
@@ -310,12 +372,16 @@ class DAGProposal(ProposalDistribution):
     prior: callable
         A prior probability on the network structures.
 
-    random_state: numpy.random.RandomState, int or None (default)
+    random_state: numpy.random.Generator, int or None (default)
         A random number generator or seed used for sampling.
 
+    n_jobs: int
+        Number of threads used to compute the parent set distributions when initializing if the score has no
+        batch_scores method. -1 uses all processors. Has no effect with BGe, which scores in parallel on its own.
+
     """
 
-    def __init__(self, moves, move_prob, score=BGe, fan_in=5, prior=None, random_state=None):
+    def __init__(self, moves, move_prob, score=BGe, fan_in=5, prior=None, random_state=None, n_jobs=1):
         super().__init__(prior=None, random_state=random_state)
 
         if not all(issubclass(move, GraphMove) for move in moves):
@@ -326,10 +392,12 @@ class DAGProposal(ProposalDistribution):
 
         self.moves = moves
         self.move_prob = np.asarray(move_prob)
+        self._move_cdf = np.cumsum(self.move_prob)
         self.score = score
         self.fan_in = fan_in
         # self.scores = ps_scores
         self.prior = prior
+        self.n_jobs = n_jobs
 
     def initialize(self, data, **kwargs):
         if isinstance(data, tuple):
@@ -340,18 +408,19 @@ class DAGProposal(ProposalDistribution):
 
         condition = kwargs['condition'] if 'condition' in kwargs else None
 
-        self.ps_scores_ = get_parent_set_distributions(variables, self.fan_in, score, rng=self.rng, condition=condition)
+        self.ps_scores_ = get_parent_set_distributions(
+            variables, self.fan_in, score, rng=self.rng, condition=condition, n_jobs=self.n_jobs)
         self.score_fn_ = score
         self.n_variables_ = variables
 
         return self
 
     def sample(self, state: DAGState):
-        if any(len(state.adj.parents(v)) > self.fan_in for v in state.adj.nodes_iter()):
+        if popcount(state.parents_bits).max() > self.fan_in:
             raise ValueError(
                 'Fan in restriction is {0} but graph has one parent set with bigger size'.format(self.fan_in))
 
-        m = self.rng.choice(len(self.moves), p=self.move_prob)
+        m = np.searchsorted(self._move_cdf, self.rng.random() * self._move_cdf[-1], side='right')
         new_state, acceptance, score_diff = self.moves[m].propose(state, self.ps_scores_, self.rng)
 
         # Maybe scale the probabilities by how likely it is to make the move?
@@ -370,9 +439,12 @@ class MBCProposal(DAGProposal):
         X, y = data
         self.n_features_ = X.shape[1]
 
-        def condition(var, ps):
+        features = np.uint64((1 << self.n_features_) - 1)
+
+        def condition(var, psets_bits):
+            # Targets can only have other targets as parents
             if var >= self.n_features_:
-                return all(p >= self.n_features_ for p in ps)
+                return (psets_bits & features) == 0
             return True
 
         DAGProposal.initialize(self, data, condition=condition)
@@ -27,7 +27,7 @@ class MHStructureSampler:
     verbose: bool
         Whether to print the progress of the algorithm
 
-    rng: numpy.random.RandomState
+    rng: numpy.random.Generator
         The random number generator used by the sampler. If none will use the default one.
     """
     def __init__(self, proposal, n_steps=1000, sample_freq=1, burn_in=None, verbose=False, rng=None):
@@ -1,86 +1,240 @@
 import numpy as np
-import scipy.sparse as ssp
+import warnings
+from copy import copy as shallow_copy
 from itertools import chain
 
+from pymoreg.core.misc import from_bits, popcount, to_bits
 from pymoreg.structure.graphs import DiGraph, MBCGraph, topsort
 
 
 class DAGState:
     """
     A state space defined as imposing a further restriction over DiGraphs to be Directed Acyclic. This property is
-    efficiently checked with an ancestor matrix which is updated after each update of deletion.
+    efficiently checked with an ancestor matrix which is updated after each update of deletion. The ancestor matrix
+    is stored as bitsets: one 64 bit mask of ancestors and one of descendants per node, so networks can have at most
+    64 nodes.
 
     Parameters
     ----------
     graph: DiGraph
         The graph with which to initialize the DAGState. If it is not a DAG an exception is raised
-
+    ancestor_matrix: None
+        Deprecated and ignored, the ancestors are always computed from the graph.
+    fan_in: int
+        The maximum number of parents of each node
+    copy: bool
+        Whether to copy the graph instead of updating it in place
 
     """
 
     def __init__(self, graph: DiGraph, ancestor_matrix=None, fan_in=5, copy=False):
-        topsort(graph)
+        if ancestor_matrix is not None:
+            warnings.warn('ancestor_matrix is deprecated and ignored, ancestors are computed from the graph',
+                          DeprecationWarning, stacklevel=2)
+
+        if graph.shape[0] > 64:
+            raise ValueError('Ancestor bitsets support at most 64 nodes, got {0}'.format(graph.shape[0]))
+
+        order = topsort(graph)
 
         self.adj = graph if not copy else graph.copy()
+        self.fan_in = fan_in
 
-        if ancestor_matrix is None:
-            ancestor_matrix = ssp.lil_matrix(self.adj.shape, dtype=bool)
-        else:
-            ancestor_matrix = ancestor_matrix.astype(bool)
+        n = self.shape[0]
 
-        for node in topsort(graph):
-            ancestors = self.adj.ancestors(node)
-            ancestor_matrix[node, ancestors] = 1
+        # Bitmasks of the parents, ancestors and descendants of each node, kept up to date on each edge update.
+        # Visiting the nodes in topological order the ancestors of the parents are known when reaching each node.
+        self.parents_bits = np.fromiter((to_bits(self.adj.parents(v)) for v in range(n)), dtype=np.uint64, count=n)
+        self.anc_bits = np.zeros(n, dtype=np.uint64)
+        self.desc_bits = np.zeros(n, dtype=np.uint64)
 
-        self.ancestor_matrix = ancestor_matrix
-        self.fan_in = fan_in
+        for v in order:
+            self.anc_bits[v] = self._parent_ancestors(v)
+            self.desc_bits[from_bits(self.anc_bits[v])] |= np.uint64(1 << int(v))
+
+        # Nodes that can be parents of each node according to the graph type
+        self._admissible = np.fromiter(
+            (to_bits(u for u in range(n) if self.adj.is_valid_edge(u, v)) for v in range(n)), dtype=np.uint64, count=n)
+
+        # Current arcs and number of arcs that can be added, updated incrementally after each edge operation
+        self._edges = [(int(u), int(v)) for u, v in zip(*self.adj.nonzero())]
+        self._addable = np.zeros(n, dtype=np.uint64)
+        self._addable_counts = np.zeros(n, dtype=int)
+        self.n_addable_ = 0
+        self._update_addable(range(n))
 
     @property
     def shape(self):
         return self.adj.shape
 
+    @property
+    def n_edges_(self):
+        return len(self._edges)
+
+    def edges(self):
+        """
+        The arcs of the graph as (tail, head) pairs. This is the list kept up to date after each edge operation, so
+        it must not be modified. Copy it if needed.
+
+        Returns
+        -------
+        list of tuple:
+            The arcs of the graph
+        """
+        return self._edges
+
     def descendants(self, node):
-        return self.ancestor_matrix.T[node].nonzero()[1]
+        return from_bits(self.desc_bits[node])
 
     def ancestors(self, node):
-        return self.ancestor_matrix[node].nonzero()[1]
+        return from_bits(self.anc_bits[node])
+
+    def orphan_descendants(self, node, orphans):
+        """
+        The descendants that node would have if the nodes in orphans lost all their parents, computed without
+        modifying the state.
+
+        Parameters
+        ----------
+        node: int
+            The node whose descendants are returned
+        orphans: list of int
+            The nodes whose incoming arcs are ignored
+
+        Returns
+        -------
+        int:
+            The bitmask of the descendants
+        """
+        orphans, descendants = to_bits(orphans), int(self.desc_bits[node])
+        if not orphans & descendants:
+            return descendants
+
+        # Visit the current descendants in topological order, keeping those still reached through some parent
+        candidates = from_bits(descendants)
+        reached = 1 << int(node)
+
+        for w in candidates[np.argsort(popcount(self.anc_bits[candidates]), kind='stable')]:
+            if not orphans >> int(w) & 1 and int(self.parents_bits[w]) & reached:
+                reached |= 1 << int(w)
+
+        return reached & ~(1 << int(node))
 
     def can_add(self, u, v):
-        return self.adj.is_valid_edge(u, v) and self.ancestor_matrix[u, v]
+        return self.adj.is_valid_edge(u, v) and bool(int(self.anc_bits[u]) >> int(v) & 1)
 
     def add_edge(self, u, v):
         self.adj[u, v] = True
+        self.parents_bits[v] |= np.uint64(1 << int(u))
         self._propagate_add(u, v)
 
+        self._edges.append((int(u), int(v)))
+        self._update_addable(chain(self.ancestors(u), [u, v]))
+
     def add_edges(self, edges):
         for u, v in edges:
-            self.adj[u, v] = True
-            self._propagate_add(u, v)
+            self.add_edge(u, v)
+
+    def add_parents(self, child, parents):
+        """
+        Add several arcs into the same node at once. The ancestors gained by the child are the union of those of
+        all the new parents, so the ancestor bitsets only need to be propagated once.
+
+        Parameters
+        ----------
+        child: int
+            The head of the arcs
+        parents: array like of int
+            The tails of the arcs. None of them can already be a parent of child.
+        """
+        parents = np.asarray(parents)
+        if not len(parents):
+            return
+
+        parents_bits = np.bitwise_or.reduce(np.uint64(1) << parents.astype(np.uint64))
+
+        self.adj[parents, child] = True
+        self.parents_bits[child] |= parents_bits
+        new_ancestors = np.bitwise_or.reduce(self.anc_bits[parents]) | parents_bits
+        self._add_ancestors(child, new_ancestors)
+
+        self._edges.extend((int(u), int(child)) for u in parents)
+        self._update_addable(chain(from_bits(new_ancestors), [child]))
+
+    def replace_parents(self, updates):
+        """
+        Replace the parents of several nodes at once. Only the updated nodes and their descendants can change
+        ancestors, so these are recomputed once in topological order of the new graph instead of after each arc.
+
+        Parameters
+        ----------
+        updates: dict
+            Maps each node to the array like of its new parents. The resulting graph must be acyclic.
+        """
+        affected = 0
+        for v, parents in updates.items():
+            affected |= int(self.desc_bits[v]) | (1 << int(v))
+
+            old_parents = from_bits(self.parents_bits[v])
+            parents = np.asarray(parents, dtype=int)
+
+            if len(old_parents):
+                self.adj[old_parents, v] = False
+            if len(parents):
+                self.adj[parents, v] = True
+
+            self.parents_bits[v] = to_bits(parents)
+
+        self._edges = [(u, v) for u, v in self._edges if v not in updates]
+        self._edges.extend((int(u), int(v)) for v in updates for u in from_bits(self.parents_bits[v]))
+
+        # A node is ready once none of its parents is waiting for its ancestors to be recomputed
+        changed = 0
+        while affected:
+            ready = [w for w in from_bits(affected) if not int(self.parents_bits[w]) & affected]
+            if not ready:
+                raise RestrictionViolation('The new parent sets create a cycle')
+
+            for w in ready:
+                ancestors, old_ancestors = self._parent_ancestors(w), self.anc_bits[w]
+
+                self.anc_bits[w] = ancestors
+                self.desc_bits[from_bits(ancestors & ~old_ancestors)] |= np.uint64(1 << int(w))
+                self.desc_bits[from_bits(old_ancestors & ~ancestors)] &= ~np.uint64(1 << int(w))
+
+                changed |= int(ancestors ^ old_ancestors)
+                affected &= ~(1 << int(w))
+
+        self._update_addable(chain(from_bits(changed), updates))
 
     def remove_edge(self, u, v):
         self.adj[u, v] = False
+        self.parents_bits[v] &= ~np.uint64(1 << int(u))
         self._propagate_delete(u, v)
 
+        self._edges.remove((int(u), int(v)))
+        self._update_addable(chain(self.ancestors(u), [u, v]))
+
     def remove_edges(self, edges):
         for u, v in zip(*edges):
             self.remove_edge(u, v)
 
     def orphan(self, node):
         if isinstance(node, int):
-            parents = self.adj.parents(node)
+            parents = from_bits(self.parents_bits[node])
             for u in parents:
                 self.remove_edge(u, node)
 
         elif isinstance(node, list):
             for n in node:
-                parents = self.adj.parents(n)
+                parents = from_bits(self.parents_bits[n])
                 for u in parents:
                     self.remove_edge(u, n)
         else:
             raise ValueError()
 
     def disconnect(self, node):
-        parents = self.adj.parents(node)
+        parents = from_bits(self.parents_bits[node])
         for u in parents:
             self.remove_edge(u, node)
 
@@ -89,10 +243,74 @@ class DAGState:
             self.remove_edge(node, v)
 
     def has_path(self, u, v):
-        return u in self.ancestors(v)
+        return bool(int(self.anc_bits[v]) >> int(u) & 1)
 
     def copy(self):
-        return DAGState(self.adj.copy(), ancestor_matrix=self.ancestor_matrix.copy(), fan_in=self.fan_in)
+        # Copy the current structures instead of rebuilding them from the graph
+        state = shallow_copy(self)
+        state.adj = self.adj.copy()
+        state.parents_bits = self.parents_bits.copy()
+        state.anc_bits = self.anc_bits.copy()
+        state.desc_bits = self.desc_bits.copy()
+        state._edges = list(self._edges)
+        state._addable = self._addable.copy()
+        state._addable_counts = self._addable_counts.copy()
+
+        return state
+
+    def addable_bits(self):
+        """
+        The arcs that can be added into each node without creating a cycle or violating the fan in and graph type
+        restrictions. These are kept up to date after each edge operation and must not be modified.
+
+        Returns
+        -------
+        numpy.ndarray:
+            Array of uint64 where each entry is the bitmask of the nodes that can be added as parents of the
+            corresponding node.
+        """
+        return self._addable
+
+    def addable_edge(self, k):
+        """
+        Find the k-th arc that can be added, with the arcs ordered by head and then by tail.
+
+        Parameters
+        ----------
+        k : int
+            The index of the arc, between 0 and n_addable_ - 1
+
+        Returns
+        -------
+        tuple:
+            The tail and head of the arc
+        """
+        cumulative = np.cumsum(self._addable_counts)
+        v = np.searchsorted(cumulative, k, side='right')
+        offset = k - cumulative[v - 1] if v else k
+
+        return from_bits(self._addable[v])[offset], v
+
+    def _update_addable(self, nodes):
+        """
+        Recompute the arcs that can be added into the given nodes. Adding or removing u --> v only changes the
+        parents of v and the descendants of u and its ancestors, so only those columns need to be updated.
+
+        Parameters
+        ----------
+        nodes : iterable of int
+            The heads of the arcs that need updating
+        """
+        nodes = np.fromiter(set(nodes), dtype=int)
+
+        parents = self.parents_bits[nodes]
+        addable = self._admissible[nodes] & ~(parents | self.desc_bits[nodes])
+        addable[popcount(parents) >= self.fan_in] = 0
+        counts = popcount(addable)
+
+        self.n_addable_ += counts.sum() - self._addable_counts[nodes].sum()
+        self._addable[nodes] = addable
+        self._addable_counts[nodes] = counts
 
     def _propagate_add(self, u, v):
         """
@@ -106,42 +324,56 @@ class DAGState:
             The head of the arc that was added
         """
 
-        new_ancestors = list(self.ancestors(u))
-        new_ancestors.append(u)
+        self._add_ancestors(v, self.anc_bits[u] | np.uint64(1 << int(u)))
 
-        to_update = list(self.descendants(v))
-        to_update.append(v)
+    def _add_ancestors(self, v, new_ancestors):
+        # Every descendant of v (and v itself) gains the new ancestors, which in turn gain all of them as descendants
+        to_update = self.desc_bits[v] | np.uint64(1 << int(v))
 
-        self.ancestor_matrix[np.ix_(to_update, new_ancestors)] = True
+        self.anc_bits[from_bits(to_update)] |= new_ancestors
+        self.desc_bits[from_bits(new_ancestors)] |= to_update
 
     def _propagate_delete(self, u, v):
         """
-        Update ancestor matrix after edge removal following the algorithm of Giudici (2003)
+        Update ancestor matrix after edge removal following the algorithm of Giudici (2003). Only the descendants of
+        v can lose ancestors, and only if v did. They are visited in topological order, which for a DAG is given by
+        the number of ancestors of each node.
 
         Parameters
         ----------
         v : int
             The head of the arc that was removed
         """
+        if self._parent_ancestors(v) == self.anc_bits[v]:
+            # u is still an ancestor of v through some other parent
+            return
+
         nodes = list(self.descendants(v))
         nodes.append(v)
+        nodes.sort(key=lambda w: popcount(self.anc_bits[w]))
 
-        self.ancestor_matrix[nodes] = False
+        for w in nodes:
+            ancestors = self._parent_ancestors(w)
+            lost = self.anc_bits[w] & ~ancestors
 
-        for n in topsort(self.adj, nodes):
-            parents = self.adj.parents(n)
-            ancestors = chain.from_iterable(self.ancestors(u) for u in parents)
+            if lost:
+                self.anc_bits[w] = ancestors
+                self.desc_bits[from_bits(lost)] &= ~np.uint64(1 << int(w))
 
-            self.ancestor_matrix[n, list(set(chain(parents, ancestors)))] = True
+    def _parent_ancestors(self, v):
+        # The ancestors of v as implied by its parents and their ancestors
+        parents = from_bits(self.parents_bits[v])
+        return np.bitwise_or.reduce(self.anc_bits[parents] | (np.uint64(1) << parents.astype(np.uint64)))
 
     def reversible_edges(self, rev=True):
+        # Every arc of a DAG can be reversed. Same list as edges(), so it must not be modified either
         if not rev:
             raise NotImplementedError()
 
-        return self.adj.nonzero()
+        return self._edges
 
     def non_admissible_edges(self):
-        return slice(None), self.adj.A.sum(axis=0) >= self.fan_in
+        return slice(None), popcount(self.parents_bits) >= self.fan_in
 
 
 class MBCState(DAGState):
@@ -150,12 +382,9 @@ class MBCState(DAGState):
         self.fixed_direction_edges = \
             np.ix_(np.arange(self.adj.n_features), np.arange(self.adj.n_features + 1, self.shape[0]))
 
-    def copy(self):
-        return MBCState(self.adj.copy(), ancestor_matrix=self.ancestor_matrix.copy(), fan_in=self.fan_in)
-
     def non_admissible_edges(self):
         edges = np.zeros(self.adj.shape, dtype=bool)
-        edges[:, self.adj.A.sum(axis=0) >= self.fan_in] = True
+        edges[:, popcount(self.parents_bits) >= self.fan_in] = True
         edges[np.ix_(range(self.adj.n_features), np.arange(self.adj.n_targets) + self.adj.n_features)] = True
 
         return edges.nonzero()
@@ -164,12 +393,8 @@ class MBCState(DAGState):
         if not rev:
             raise NotImplementedError()
 
-        edges = np.ones(self.adj.shape, dtype=bool)
-        edges[np.ix_(np.arange(self.adj.n_targets) + self.adj.n_features, range(self.adj.n_features))] = False
-
-        edges = np.logical_and(edges, self.adj.A)
-
-        return edges.nonzero()
+        # Arcs from targets to features can't be reversed
+        return [(u, v) for u, v in self._edges if self.adj.is_valid_edge(v, u)]
 
 
 class RestrictionViolation(Exception):
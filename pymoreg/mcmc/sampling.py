@@ -52,7 +52,7 @@ def metropolis_hastings(s0, proposal, n_steps=1000, burn_in=None, save_iter=1, i
         proposed[m] += 1
 
         r = np.exp(min(0, acceptance))
-        p = rng.random_sample()
+        p = rng.random()
 
         if p < r:
             # print("accepted")
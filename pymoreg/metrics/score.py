@@ -1,13 +1,55 @@
 import numpy as np
+from numba import njit, prange
 from scipy.linalg import solve_triangular, cholesky
 from scipy.special import gammaln
 
-from pymoreg.core.misc import det_2by2, logdet_traingular
+from pymoreg.core.misc import det_2by2, logdet_traingular, popcount
 from pymoreg.structure.graphs import DiGraph
 
 from pymoreg.core.gaussian import update_normal_wishart_parameters
 
 
+@njit(parallel=True, fastmath=True, cache=True)
+def _bge_batch(sn, x, psets_bits, max_size, indep_term, vn):
+    # Score each parent set of x in parallel. The Cholesky factor of the scale matrix restricted to the parents
+    # followed by x gives both log-determinants: the one of the parents from its first k diagonal entries, and the
+    # Schur complement of x given its parents as the square of the last one.
+    d = sn.shape[0]
+    scores = np.empty(psets_bits.shape[0])
+
+    for t in prange(psets_bits.shape[0]):
+        bits = psets_bits[t]
+        idx = np.empty(max_size + 1, dtype=np.int64)
+        l = np.empty((max_size + 1, max_size + 1))
+
+        k = 0
+        for i in range(d):
+            if (bits >> np.uint64(i)) & np.uint64(1):
+                idx[k] = i
+                k += 1
+        idx[k] = x
+
+        for r in range(k + 1):
+            for c in range(r + 1):
+                acc = sn[idx[r], idx[c]]
+                for q in range(c):
+                    acc -= l[r, q] * l[c, q]
+
+                if r == c:
+                    l[r, r] = np.sqrt(acc)
+                else:
+                    l[r, c] = acc / l[c, c]
+
+        log_det_p = 0.0
+        for i in range(k):
+            log_det_p += 2 * np.log(l[i, i])
+
+        log_det2 = 2 * np.log(l[k, k])
+        scores[t] = indep_term[k] - (vn - d + k + 1) / 2 * log_det2 - log_det_p / 2
+
+    return scores
+
+
 class BGe:
     """
         The log-score the structure of the distribution of a variable given a set of parents according to the data
@@ -101,6 +143,27 @@ class BGe:
 
         return np.sum([self._set_score_ratio(x, ps) for x, ps in structure])
 
+    def batch_scores(self, x, psets_bits):
+        """
+        Compute the score of many parent sets of the same variable at once.
+
+        Parameters
+        ----------
+        x: int
+            The index of the variable
+        psets_bits: numpy.ndarray
+            Array of uint64 with the bitmasks of the parent sets. None of them may contain x.
+
+        Returns
+        -------
+        numpy.ndarray:
+            The score of each parent set
+        """
+        psets_bits = np.asarray(psets_bits, dtype=np.uint64)
+        max_size = popcount(psets_bits).max() if len(psets_bits) else 0
+
+        return _bge_batch(self.sn, x, psets_bits, max_size, self.indep_term, self.vn)
+
     def _set_score_ratio(self, x, parent_set):
         if parent_set is None:
             parent_set = []
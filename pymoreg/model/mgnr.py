@@ -179,7 +179,7 @@ class MGNREnsemble(BaseEstimator, RegressorMixin):
             The algorithm used to determine the values of the regression coefficients.
         structure_fitter: MHStructureOptimizer
             The algorithm used to learn the structure of the model
-        rng: RandomState, int or None (default)
+        rng: Generator, int or None (default)
             A random state for the class and al its members.
         """
         if structure_fitter is None:
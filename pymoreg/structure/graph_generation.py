@@ -17,7 +17,7 @@ def random_dag(variables, fan_in=-1, rng=None):
 
     for i, node in enumerate(variables[1:]):
         i += 1
-        n_parents = rng.choice(min(fan_in, i) + 1)
+        n_parents = rng.integers(min(fan_in, i) + 1)
         parents = rng.choice(variables[:i], size=n_parents, replace=False)
         if len(parents):
             g.add_edges([(p, node) for p in parents])
@@ -32,7 +32,7 @@ def random_mbc(n_features, n_targets, fan_in=-1, rng=None):
     if fan_in == -1:
         fan_in = n_vars - 1
 
-    g = rng.randint(0, 2, size=(n_vars, n_vars))
+    g = rng.integers(0, 2, size=(n_vars, n_vars))
 
     for i in range(n_vars):
         g[i, i:] = 0
@@ -1,16 +1,16 @@
 import numpy as np
 from pymoreg.core.gaussian import sample_from_gn
 from pymoreg.metrics.score import BGe
-from numpy.random import RandomState
-from pymoreg.structure.graph_generation import random_dag
+from numpy.random import default_rng
+from pymoreg.structure.graph_generation import random_dag, random_mbc
 
-from pymoreg.mcmc.graphs.state_space import DAGState, RestrictionViolation
-from pymoreg.mcmc.graphs.checks import check_consistency
-from pymoreg.mcmc.graphs.proposal import get_parent_set_distributions, basic_move, rev_move
+from pymoreg.mcmc.graphs.state_space import DAGState, MBCState, RestrictionViolation
+from pymoreg.mcmc.graphs.checks import check_consistency, check_cached_structures, check_orphan_descendants
+from pymoreg.mcmc.graphs.proposal import get_parent_set_distributions, MBCProposal, basic_move, rev_move, nbhr_move
 
 n_variables = 15
 seeds = list(range(101, 200))
-rng = RandomState(19023)
+rng = default_rng(19023)
 variables = list(range(n_variables))
 n_samples = 200
 
@@ -24,7 +24,7 @@ gen_weight = 2
 graph = random_dag(variables, rng=rng)
 beta = graph.A.T * gen_weight
 
-sample_seed = rng.randint(0, 2**32-1)
+sample_seed = rng.integers(0, 2**32-1)
 data_gn = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
 
 # Fit the score and create the parent set distributions
@@ -33,35 +33,51 @@ fan_in = 5
 bge = BGe(data_gn)
 ps_dist = get_parent_set_distributions(variables, fan_in, bge, rng=rng)
 
-# Some random state to start
-state = DAGState(random_dag(variables, fan_in, rng=rng))
+# Basic moves
+moves = [basic_move, rev_move, nbhr_move]
 
-# Check consistency of first state
-check_consistency(state)
 
-# Basic moves
-moves = [basic_move, rev_move]
+def test_moves(state, ps_dist, tests=100):
+    # Check consistency of first state
+    check_consistency(state)
+    check_cached_structures(state)
+
+    s, f = 0, 0
+
+    # Randomly apply moves to test them
+    for i in range(tests):
+        print('Test {0}/{1}...'.format(i + 1, tests))
 
-s, f = 0, 0
+        m = moves[rng.integers(len(moves))]
+        edges = state.edges()
 
-# Randomly apply moves to test them
-tests = 100
-for i in range(tests):
-    print('Test {0}/{1}...'.format(i + 1, len(seeds)))
+        # The descendants sampled from by the reversal move
+        if len(edges):
+            check_orphan_descendants(state, edges[rng.integers(len(edges))])
 
-    state.fan_in_ = fan_in
+        new_state, _, _ = m.propose(state, ps_dist, rng)
+
+        try:
+            check_consistency(new_state)
+            check_cached_structures(new_state)
+            state = new_state
+            s += 1
+            print('pass')
+        except RestrictionViolation:
+            f += 1
+            print('fail')
+
+    print('Test finished. {0}/{1} successes'.format(s, tests))
+
+
+# Some random state to start
+test_moves(DAGState(random_dag(variables, fan_in, rng=rng), fan_in=fan_in), ps_dist)
 
-    m = rng.choice(moves)
-    edges = m.moves(state)
-    new_state, _, _ = m.propose(state, ps_dist, rng)
+# Same for a MBC, where the parent sets of the targets can't contain features
+n_features = 10
 
-    try:
-        check_consistency(new_state)
-        state = new_state
-        s += 1
-        print('pass')
-    except RestrictionViolation:
-        f += 1
-        print('fail')
+proposal = MBCProposal(moves, move_prob=[1/3, 1/3, 1/3], fan_in=fan_in, random_state=rng)
+proposal.initialize((data_gn[:, :n_features], data_gn[:, n_features:]))
 
-print('Test finished. {0}/{1} successes'.format(s, tests))
+mbc = random_mbc(n_features, n_variables - n_features, fan_in, rng=rng)
+test_moves(MBCState(mbc, fan_in=fan_in), proposal.ps_scores_)
@@ -1,12 +1,12 @@
 import numpy as np
 from numpy.linalg import norm
-from numpy.random import RandomState
+from numpy.random import default_rng
 from pymoreg.structure.graph_generation import random_dag
 
 from pymoreg.core.gaussian import sample_from_gn, to_mvn
 
 seeds = list(range(101, 200))
-rng = RandomState()
+rng = default_rng()
 variables = list(range(5))
 
 gen_mean = np.zeros(len(variables))
@@ -25,7 +25,7 @@ for i, s in enumerate(seeds):
     mvn = to_mvn(gen_mean, gen_var, beta, return_mvn=True)
 
     n_samples = 200
-    sample_seed = rng.randint(0, 2**32-1)
+    sample_seed = rng.integers(0, 2**32-1)
 
     data_gn = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
     data_mvn = mvn.rvs(n_samples, sample_seed)
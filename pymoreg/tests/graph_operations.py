@@ -1,16 +1,15 @@
 from networkx import nx
-from numpy.random import RandomState
+from numpy.random import default_rng
 
 from pymoreg.structure.graph_generation import random_dag
 
 seeds = list(range(101, 200))
-rng = RandomState()
 variables = list(range(15))
 
 for i, s in enumerate(seeds):
     print('Test {0}/{1}'.format(i + 1, len(seeds)))
 
-    rng.seed(s)
+    rng = default_rng(s)
     g = random_dag(variables, rng=rng)
     nx_g = nx.from_scipy_sparse_matrix(g, create_using=nx.DiGraph())
 
@@ -54,7 +53,7 @@ for i, s in enumerate(seeds):
                 raise ValueError('Error in graph created with seed {2}\n Expected children for node {3}: {0}\n got: {1}'
                                  .format(s, real_children, children, v))
 
-        e = edges[rng.choice(len(edges))]
+        e = edges[rng.integers(len(edges))]
 
         g.remove_edge(*e)
         nx_g.remove_edge(*e)
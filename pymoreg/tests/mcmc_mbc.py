@@ -3,7 +3,7 @@ import numpy as np
 import seaborn as sns
 from pymoreg.core.gaussian import sample_from_gn
 from pymoreg.metrics.score import BGe
-from numpy.random import RandomState
+from numpy.random import default_rng
 from pymoreg.structure.graph_generation import random_mbc
 # from pymoreg.structure.graphs import plot_digraph
 
@@ -17,7 +17,7 @@ SAVE = False
 n_variables = 15
 n_features = 10
 seeds = list(range(101, 200))
-rng = RandomState(1802)
+rng = default_rng(1802)
 variables = list(range(n_variables))
 n_samples = 200
 
@@ -30,7 +30,7 @@ gen_weight = 2
 graph = random_mbc(n_features, n_variables - n_features, rng=rng, fan_in=5)
 beta = graph.A.T * gen_weight
 
-sample_seed = rng.randint(0, 2 ** 32 - 1)
+sample_seed = rng.integers(0, 2 ** 32 - 1)
 data_gn = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
 
 graph_score = BGe(data_gn)(graph)
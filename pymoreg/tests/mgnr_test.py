@@ -1,7 +1,7 @@
 import numpy as np
 import seaborn as sns
 from sklearn.metrics import mean_squared_error
-from numpy.random import RandomState
+from numpy.random import default_rng
 
 from pymoreg.core.gaussian import sample_from_gn
 from pymoreg.core.gaussian import to_mvn, gn_params_ridge
@@ -20,7 +20,7 @@ SAVE = False
 n_variables = 15
 n_features = 10
 seeds = list(range(101, 200))
-rng = RandomState(1802)
+rng = default_rng(1802)
 variables = list(range(n_variables))
 n_samples = 300
 
@@ -33,7 +33,7 @@ gen_var = rng.gamma(shape=1, size=n_variables)
 graph = random_mbc(n_features, n_variables - n_features, rng=rng, fan_in=5)
 beta = np.multiply(graph.A.T, rng.normal(0, 2, size=graph.shape))
 
-sample_seed = rng.randint(0, 2 ** 32 - 1)
+sample_seed = rng.integers(0, 2 ** 32 - 1)
 data = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
 test = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
 
@@ -1,13 +1,13 @@
 import numpy as np
 from numpy.linalg import norm
-from numpy.random import RandomState
+from numpy.random import default_rng
 from sklearn.linear_model import LinearRegression
 from pymoreg.structure.graph_generation import random_dag
 
 from pymoreg.core.gaussian import sample_from_gn, to_mvn, gn_params
 
 seeds = list(range(101, 200))
-rng = RandomState()
+rng = default_rng()
 variables = list(range(5))
 n_samples = 200
 
@@ -38,7 +38,7 @@ for i, s in enumerate(seeds):
 
     beta = graph.T * gen_weight
 
-    sample_seed = rng.randint(0, 2**32-1)
+    sample_seed = rng.integers(0, 2**32-1)
 
     data_gn = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
 
@@ -1,16 +1,17 @@
 import numpy as np
 from pymoreg.core.gaussian import sample_from_gn
 from pymoreg.metrics.score import BGe
-from numpy.random import RandomState
+from numpy.random import default_rng
 from pymoreg.structure.graph_generation import random_dag
 
 from pymoreg.mcmc.graphs.state_space import RestrictionViolation
 from pymoreg.mcmc.graphs.checks import check_distribution
+from pymoreg.core.misc import from_bits, popcount, power_set_bits
 from pymoreg.mcmc.graphs.proposal import get_parent_set_distributions
 
 n_variables = 15
 seeds = list(range(101, 200))
-rng = RandomState(19023)
+rng = default_rng(19023)
 variables = list(range(n_variables))
 n_samples = 200
 
@@ -23,7 +24,7 @@ gen_weight = 2
 graph = random_dag(variables, rng=rng)
 beta = graph.A.T * gen_weight
 
-sample_seed = rng.randint(0, 2 ** 32 - 1)
+sample_seed = rng.integers(0, 2 ** 32 - 1)
 data_gn = sample_from_gn(graph, gen_mean, gen_var, beta, n_samples, sample_seed)
 
 # Fit the score and create the parent set distributions
@@ -47,4 +48,26 @@ for v, dist in enumerate(ps_dist):
 
     print('Test finished. {0}/{1} successes'.format(s, len(ps_dist)))
 
+print('Checking batch scores')
+s, f = 0, 0
+
+# All the parent sets up to the fan in, so each of the branches of the scalar score (0, 1, 2 and 3+ parents) is used
+sets_bits = power_set_bits(n_variables, fan_in)
+
+for v in variables:
+    print('Node {0}...'.format(v))
+    psets = sets_bits[((sets_bits >> np.uint64(v)) & np.uint64(1)) == 0]
+
+    batch = bge.batch_scores(v, psets)
+    scalar = np.asarray([bge((v, from_bits(ps))) for ps in psets])
+
+    if np.allclose(batch, scalar) and set(popcount(psets)) == set(range(fan_in + 1)):
+        s += 1
+        print('pass')
+    else:
+        f += 1
+        print('fail, max difference {0}'.format(np.abs(batch - scalar).max()))
+
+print('Test finished. {0}/{1} successes'.format(s, n_variables))
+
 print('Checking moves')
@@ -20,7 +20,7 @@ AUTHOR = 'Milton Llera'
 
 # What packages are required for this module to be executed?
 REQUIRED = [
-    'numpy', 'scipy', 'networkx', 'scikit-learn', 'pandas', 'matplotlib', 'seaborn', 'pygraphviz'
+    'numpy', 'scipy', 'numba', 'joblib', 'networkx', 'scikit-learn', 'pandas', 'matplotlib', 'seaborn', 'pygraphviz'
 ]
 
 # The rest you shouldn't have to touch too much :)